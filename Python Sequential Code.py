@@ -1,15 +1,125 @@
-import random
-from collections import defaultdict
 import pandas as pd
+import os
+import matplotlib
+# HEADLESS=1 (batch runs, parameter sweeps): no GUI backend, figures are saved to PNG instead of shown
+HEADLESS = os.environ.get('HEADLESS', '').strip().lower() in ('1', 'true', 'yes', 'on')
+if HEADLESS:
+    matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import csv
-import os
+import types
+import warnings
+import multiprocessing as mp
+from multiprocessing import shared_memory, util as mp_util
 import gym
 from gym import spaces
 import numpy as np
 
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError: # Fall back to plain Python so the script still runs without numba
+    HAS_NUMBA = False
+    prange = range
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
+
+try:
+    import cupy as cp
+    from numba import cuda
+    from numba.cuda.random import create_xoroshiro128p_states, xoroshiro128p_uniform_float32
+    HAS_CUDA = cuda.is_available()
+except ImportError: # No GPU stack, only the CPU environments are available
+    HAS_CUDA = False
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    HAS_PYARROW = True
+except ImportError: # Logs are written as CSV instead of Parquet
+    HAS_PYARROW = False
+
 os.environ['PYDEVD_DISABLE_FILE_VALIDATION'] = '1'
 
+if not HAS_NUMBA:
+    warnings.warn("numba is not installed: the compiled step kernel and episode loops run as (much slower) pure Python")
+
+# Card ids used by the compiled kernel (decks are stored as int8 arrays of these ids)
+CARD_ADVANCE_GO = 0
+CARD_GO_TO_JAIL = 1
+CARD_DIVIDEND = 2     # Bank pays you dividend
+CARD_POOR_TAX = 3     # Pay poor tax
+CARD_DOCTORS_FEE = 4
+CARD_TAX_REFUND = 5   # Income tax refund
+# Money change for each card id (0 for the cards that move the player)
+CARD_MONEY = np.array([0, 0, 50, -15, -50, 20], dtype=np.int16)
+# Card names by id, only needed for the logs
+CARD_NAMES = ("Advance to Go", "Go to Jail", "Bank pays you dividend", "Pay poor tax", "Doctor's fee", "Income tax refund")
+
+# Square kinds stored in MonopolyEnv.square_kind
+SQUARE_NOOP = 0       # GO, Jail, Free Parking, ...
+SQUARE_FEE = 1
+SQUARE_PROPERTY = 2
+SQUARE_GO_TO_JAIL = 3
+SQUARE_CHANCE = 4
+SQUARE_CHEST = 5
+
+JAIL_FEE = 50 # Paid to leave jail once the turn limit is reached
+
+# Per-step record filled by the compiled kernel (_step_numeric); the logs are built from it
+LOG_JAIL = 0          # JAIL_* outcome, for a turn started in jail
+LOG_POS_BEFORE = 1    # Position at the start of the turn
+LOG_PASSED_GO = 2
+LOG_LANDED = 3        # Square reached by the dice, before any card move
+LOG_CARD = 4          # Card id drawn, -1 if none
+LOG_CARD_REWARD = 5
+LOG_SQUARE = 6        # Square whose action was resolved (after any card move)
+LOG_EVENT = 7         # EVENT_* code of that square action
+LOG_AMOUNT = 8        # Fee / price / rent of that action
+LOG_FEE_PAID = 9      # Everything paid this turn (jail fee, fee, purchase, rent)
+LOG_BANKRUPT = 10
+LOG_SIZE = 11
+
+JAIL_NONE = 0
+JAIL_DOUBLES = 1      # Rolled doubles, moves this turn
+JAIL_PAID = 2         # Paid JAIL_FEE, moves this turn
+JAIL_STAYED = 3       # Turn spent in jail
+
+EVENT_NONE = 0
+EVENT_GO_TO_JAIL = 1
+EVENT_FEE = 2
+EVENT_BUY = 3
+EVENT_PASS = 4        # Could buy, chose not to
+EVENT_CANT_AFFORD = 5
+EVENT_RENT = 6
+EVENT_OWN = 7         # Landed on own property
+
+# Bit layout of the agent's packed state key:
+# position (6 bits) | money // 100, capped (8 bits) | in_jail (1 bit) | owner of current square + 1 (3 bits)
+STATE_MONEY_SHIFT = 6
+STATE_JAIL_SHIFT = 14
+STATE_OWNER_SHIFT = 15
+STATE_KEY_BITS = 18 # Size of the agent's dense Q-table: 1 << STATE_KEY_BITS states
+# Money above this shares the top money bin (money // 100 has to fit in its 8 bits)
+STATE_MAX_MONEY = (1 << (STATE_JAIL_SHIFT - STATE_MONEY_SHIFT)) * 100 - 1
+
+def check_state_key_fits(num_players, board_size=0):
+    """Raises ValueError if a game's positions or owners do not fit the packed key's fields
+    (they would overlap other fields or index past the end of the agent's Q-table)."""
+    if board_size > 1 << STATE_MONEY_SHIFT:
+        raise ValueError(f"board_size={board_size} does not fit the state key (at most {1 << STATE_MONEY_SHIFT} squares)")
+    if num_players >= 1 << (STATE_KEY_BITS - STATE_OWNER_SHIFT): # Owner field holds owner + 1, -1 = unowned
+        raise ValueError(f"num_players={num_players} does not fit the state key "
+                         f"(at most {(1 << (STATE_KEY_BITS - STATE_OWNER_SHIFT)) - 1} players)")
+
+# Returned as step() info when logging is disabled (read-only, so it can be shared by every step)
+_EMPTY_INFO = types.MappingProxyType({})
+
+# Number of dice rolls / card draws generated per refill of the env's random buffers
+RNG_BUFFER_SIZE = 65536
+
 class Property:
     def __init__(self, name, base_rent, house_cost, color_group):
         self.name = name
@@ -28,12 +138,9 @@ class Property:
             return self.base_rent * 5  # Example multiplier
         return self.base_rent + (self.house_count * (self.base_rent // 2))
 
-    def can_buy_house(self, player, all_properties):
-        owns_group = all(
-            prop.owner == player
-            for prop in all_properties
-            if prop.color_group == self.color_group
-        )
+    def can_buy_house(self, player, player_index, pos, env):
+        # One read of the env's cached sole owner of pos's color group instead of scanning every property
+        owns_group = env.owns_color_group(player_index, pos)
         return (
             self.owner == player
             and owns_group
@@ -41,18 +148,127 @@ class Property:
             and player.money >= self.house_cost
         )
 
-    def buy_house(self, player):
-        if self.can_buy_house(player, []):  # You’ll need to pass properties list in real use
+    def buy_house(self, player, player_index, pos, env):
+        if self.can_buy_house(player, player_index, pos, env):
             self.house_count += 1
             player.money -= self.house_cost
 
 
+# --- Columnar Step Log ---
+class StepLog:
+    """Per-step log kept as one preallocated column per field instead of one dict per step.
+    Full chunks are appended to a Parquet or CSV file (fmt; Parquet by default when pyarrow is installed)."""
+    dtypes = {
+        "episode_id": np.int32, "step": np.int32, "player": np.int8, "position_before": np.int8,
+        "dice_roll": np.int8, "landed_on_position": np.int8, "position_after": np.int8,
+        "money_before": np.int32, "money_after": np.int32, "reward": np.int32, "done": np.bool_,
+        "in_jail": np.bool_, "fee_paid": np.int32, "agent_action": np.int8,
+        "action_desc_code": np.int8, # EVENT_* code of the square action, filterable without parsing action_desc
+        # Text columns
+        "action_desc": object, "owned_properties": object, "card": object, "card_specific_desc": object,
+    }
+
+    def __init__(self, path, columns, chunk_rows=1 << 20, fmt=None):
+        if fmt is None:
+            fmt = "parquet" if HAS_PYARROW else "csv"
+        if fmt not in ("parquet", "csv"):
+            raise ValueError(f"Unknown log format {fmt!r} (expected 'parquet' or 'csv')")
+        if fmt == "parquet" and not HAS_PYARROW:
+            raise ValueError("Parquet logs need pyarrow; install it or use fmt='csv'")
+        self.fmt = fmt
+        self.path = path
+        self.columns = list(columns)
+        self.chunk_rows = chunk_rows
+        self.cols = {name: np.empty(chunk_rows, dtype=self.dtypes[name]) for name in self.columns}
+        self.n = 0 # Rows filled in the current chunk
+        self.rows_written = 0 # Rows flushed to the file so far
+        self.episode_id = -1 # Set by generate_episode, stamped on every row
+        self._writer = None # ParquetWriter, opened with the first chunk
+        self._file = None # CSV fallback: file and csv.writer, opened (and the header written) with the first chunk
+        self._csv = None
+
+    def add(self, step, player, pos_before, dice, landed_on, pos_after, money_before, money_after, reward,
+            done, in_jail, fee_paid, action_taken, log_desc, action_desc_code, owned_properties, card, card_spec_desc):
+        c, i = self.cols, self.n
+        c["episode_id"][i] = self.episode_id
+        c["step"][i] = step
+        c["player"][i] = player
+        c["position_before"][i] = pos_before
+        c["dice_roll"][i] = dice
+        c["landed_on_position"][i] = landed_on
+        c["position_after"][i] = pos_after
+        c["money_before"][i] = money_before
+        c["money_after"][i] = money_after
+        c["reward"][i] = reward
+        c["done"][i] = done
+        c["in_jail"][i] = in_jail
+        c["fee_paid"][i] = fee_paid
+        c["agent_action"][i] = action_taken
+        c["action_desc"][i] = log_desc
+        c["action_desc_code"][i] = action_desc_code
+        c["owned_properties"][i] = owned_properties
+        c["card"][i] = card
+        c["card_specific_desc"][i] = card_spec_desc
+        self.n = i + 1
+        if self.n == self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        """Appends the filled rows to the log file and starts a new chunk."""
+        if self.n == 0:
+            return
+        chunk = {name: self.cols[name][:self.n] for name in self.columns}
+        if self.fmt == "parquet":
+            table = pa.Table.from_pydict(chunk)
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.path, table.schema)
+            self._writer.write_table(table)
+        else:
+            if self._csv is None:
+                self._file = open(self.path, "w", newline="", encoding="utf-8") # Replaces a log from an earlier run
+                self._csv = csv.writer(self._file, lineterminator="\n")
+                self._csv.writerow(self.columns)
+            # Rows straight from the columns (tolist gives Python scalars, no DataFrame in between)
+            self._csv.writerows(zip(*[chunk[name].tolist() for name in self.columns]))
+        self.rows_written += self.n
+        self.n = 0
+
+    def close(self):
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._file is not None:
+            self._file.close()
+            self._file = self._csv = None
+
+
 class MonopolyEnv(gym.Env):
     metadata = {'render.modes': ['human']} # Gym convention
-
-    def __init__(self, go_reward=200, start_money=1500, board_size=40, num_players=2):
+    # Per-step state gets fixed slots, hottest fields first. Cold data (property_details, prop_names,
+    # the Gym spaces) stays in the instance __dict__ that gym.Env provides.
+    __slots__ = (
+        'positions', 'money', 'money_bin', 'in_jail', 'jail_counters', 'current_player',
+        'prop_owner', 'prop_houses', 'prop_price', 'buy_price', 'rent_table',
+        'square_kind', 'fee_lookup', 'chance_cards', 'chest_cards', 'color_of', 'group_owner', 'owned_by_player',
+        '_obs_buf', '_roll_buf', '_roll_idx', '_log_rec',
+        'steps_taken', 'done', '_log_enabled', 'step_log', 'min_money', 'max_money',
+        'num_players', 'board_size', 'go_reward', 'jail_position', 'go_to_jail_position', 'jail_turns',
+    )
+
+    def __init__(self, go_reward=200, start_money=1500, board_size=40, num_players=2, seed=None):
         super().__init__() # Initialize Gym Env
 
+        # Per-step log entries are only built when enabled (see enable_logging)
+        self._log_enabled = False
+        self.step_log = None
+
+        # Dice and card draws come from pre-generated buffers instead of one random call each
+        self._rng = np.random.default_rng(seed)
+        self._refill_rolls()
+        # What happened during the last step, written by the kernel
+        self._log_rec = np.zeros(LOG_SIZE, dtype=np.int64)
+
         self.go_reward = go_reward
         self.start_money = start_money
         self.board_size = board_size
@@ -66,25 +282,16 @@ class MonopolyEnv(gym.Env):
             28: 150,  # Electric company - Often utility, let's keep as fee for now
             38: 100,  # Luxury tax
         }
-        self.chance_deck = [
-            {"name": "Advance to Go", "effect": self.advance_to_go},
-            {"name": "Go to Jail", "effect": self.go_to_jail},
-            {"name": "Bank pays you dividend", "effect": lambda p: self.adjust_money(p, 50)},
-            {"name": "Pay poor tax", "effect": lambda p: self.adjust_money(p, -15)},
-            # Add more as needed
-        ]
-
-        self.chest_deck = [
-            {"name": "Doctor's fee", "effect": lambda p: self.adjust_money(p, -50)},
-            {"name": "Income tax refund", "effect": lambda p: self.adjust_money(p, 20)},
-            {"name": "Go to Jail", "effect": self.go_to_jail},
-            {"name": "Advance to Go", "effect": self.advance_to_go},
-            # Add more as needed
-        ]
+        # Decks are arrays of card ids (see CARD_*); effects are applied by the kernel
+        self.chance_cards = np.array([CARD_ADVANCE_GO, CARD_GO_TO_JAIL, CARD_DIVIDEND, CARD_POOR_TAX], dtype=np.int8)
+        self.chest_cards = np.array([CARD_DOCTORS_FEE, CARD_TAX_REFUND, CARD_GO_TO_JAIL, CARD_ADVANCE_GO], dtype=np.int8)
 
         # Set the board squares that are Chance or Chest
         self.chance_positions = {7, 22, 36}
         self.chest_positions = {2, 17, 33}
+        # Per-square lookup tables (used by step() and the compiled kernel instead of the sets/dict above)
+        self.fee_lookup = np.zeros(self.board_size, dtype=np.int16)
+        self.fee_lookup[list(self.fee_positions)] = list(self.fee_positions.values())
         # Define standard Monopoly property prices/rents (simplified)
         # You could load this from a file for a real game
         # Format: {position: {"price": price, "rent": rent, "name": name}}
@@ -122,6 +329,43 @@ class MonopolyEnv(gym.Env):
         for i in range(self.board_size):
              if i not in self.property_details:
                  self.property_details[i] = {"price": 0, "rent": 0, "name": f"Square {i}"} # GO, Jail, Taxes etc.
+        # Names are only needed for logs, so they live in their own list outside the numeric tables
+        self.prop_names = [self.property_details[pos]["name"] for pos in range(self.board_size)]
+        # Static property tables, indexed by board position (built once, never change during a game)
+        self.prop_price = np.array([self.property_details[pos]["price"] for pos in range(self.board_size)], dtype=np.int16)
+        self.prop_rent = np.array([self.property_details[pos]["rent"] for pos in range(self.board_size)], dtype=np.int16)
+        # Rent due for every (position, houses) pair, houses = 0..5 (5 = hotel)
+        self.rent_table = (self.prop_rent[:, None] * np.arange(1, 7, dtype=np.int16)).astype(np.int16)
+
+        # What happens on each square (SQUARE_* codes); later assignments take precedence,
+        # e.g. the utilities have a price but are treated as fee squares
+        self.square_kind = np.full(self.board_size, SQUARE_NOOP, dtype=np.int8)
+        self.square_kind[self.prop_price > 0] = SQUARE_PROPERTY
+        self.square_kind[list(self.chance_positions)] = SQUARE_CHANCE
+        self.square_kind[list(self.chest_positions)] = SQUARE_CHEST
+        self.square_kind[self.fee_lookup > 0] = SQUARE_FEE
+        self.square_kind[self.go_to_jail_position] = SQUARE_GO_TO_JAIL
+        # Price of each square the player can actually buy, 0 elsewhere (utilities have a price but act as fees)
+        self.buy_price = np.where(self.square_kind == SQUARE_PROPERTY, self.prop_price, 0).astype(np.int16)
+        # No-op squares that get a "non-action square" log line (GO and Jail are not reported)
+        self.quiet_square = self.square_kind == SQUARE_NOOP
+        self.quiet_square[[0, self.jail_position, self.go_to_jail_position]] = False
+
+        # Color groups houses can be built on (utilities are fee squares here, railroads take no houses)
+        self.color_groups = {
+            "Brown": [1, 3],
+            "Light Blue": [6, 8, 9],
+            "Pink": [11, 13, 14],
+            "Orange": [16, 18, 19],
+            "Red": [21, 23, 24],
+            "Yellow": [26, 27, 29],
+            "Green": [31, 32, 34],
+            "Dark Blue": [37, 39],
+        }
+        self.group_members = [np.array(members) for members in self.color_groups.values()]
+        self.color_of = np.full(self.board_size, -1, dtype=np.int8) # Group index per square, -1 = no group
+        for c, members in enumerate(self.group_members):
+            self.color_of[members] = c
 
         # --- Action Space ---
         # Action 0: Don't Buy / Continue
@@ -146,64 +390,65 @@ class MonopolyEnv(gym.Env):
             [self.num_players - 1] * self.board_size +
             [self.num_players - 1]
         )
-        self.observation_space = spaces.Box(low, high, dtype=np.int32)
+        # int16 when every bound fits (money is clamped to start_money * 10 in _get_obs), int32 for large start_money
+        obs_dtype = np.int16 if high.max() <= np.iinfo(np.int16).max else np.int32
+        self.observation_space = spaces.Box(low, high, dtype=obs_dtype)
+        # Money bounds of the observation, cached for _get_obs
+        self.min_money = int(self.observation_space.low[self.num_players])
+        self.max_money = int(self.observation_space.high[self.num_players])
+
+        # Game state arrays are allocated once here; reset() only refills them
+        self.positions = np.zeros(self.num_players, dtype=np.int8)
+        self.money = np.zeros(self.num_players, dtype=np.int32)
+        # Agent's $100 money bucket of each player (money clamped like the observation), updated only when money changes
+        self.money_bin = np.zeros(self.num_players, dtype=np.int16)
+        self.in_jail = np.zeros(self.num_players, dtype=np.bool_)
+        self.jail_counters = np.zeros(self.num_players, dtype=np.int8)
+        # Board state is kept as parallel arrays (one slot per square) instead of a list of dicts
+        # Owner -1 means the square is not owned by anyone
+        self.prop_owner = np.zeros(self.board_size, dtype=np.int8)
+        self.prop_houses = np.zeros(self.board_size, dtype=np.int8)
+        # Sole owner of each color group, -1 if the group is unowned or split; kept in sync with prop_owner
+        self.group_owner = np.zeros(len(self.group_members), dtype=np.int8)
+        # Squares owned by each player, kept in sync with prop_owner (only read by the logs)
+        self.owned_by_player = [set() for _ in range(self.num_players)]
+        # Observation buffer reused by every _get_obs() call
+        self._obs_buf = np.empty(3 * self.num_players + self.board_size + 1, dtype=self.observation_space.dtype)
 
         self.reset()
-    def adjust_money(self, player, amount):
-          self.money[player] += amount
-          reward = amount # Reward is the money change
-          # Check for bankruptcy *immediately* after money adjustment
-          done = self.money[player] < 0
-          info = {"card": f"Money change: {amount}", "card_specific_desc": f" Adjusted money by {amount}."}
-          # Note: We don't return the full log entry here, step() will assemble it.
-          # We just return the core results of the card effect.
-          return self._get_obs(), reward, done, info
-
-    def adjust_money(self, player, amount):
-        """Adjusts player money and returns reward contribution + description."""
-        self.money[player] += amount
-        reward_contribution = amount # Reward is the direct change
-        desc = f"Adjusted money by {amount}."
-        # Note: Bankruptcy check happens *later* in the main step function
-        return {"reward": reward_contribution, "card_specific_desc": desc}
-
-    def advance_to_go(self, player):
-        """Moves player to GO, adds GO reward, returns reward contribution + description."""
-        passed_go = self.positions[player] > 0 # Only collect if not already at GO
-        self.positions[player] = 0
-        reward_contribution = 0
-        desc = "Advanced to GO."
-        if passed_go:
-            self.money[player] += self.go_reward
-            reward_contribution += self.go_reward
-            desc += f" Collected ${self.go_reward}."
-        return {"reward": reward_contribution, "card_specific_desc": desc}
-
-    def go_to_jail(self, player):
-        """Moves player to Jail position, sets jail status, returns reward contribution + description."""
-        self.positions[player] = self.jail_position
-        self.in_jail[player] = True
-        self.jail_counters[player] = 0
-        reward_contribution = 0 # Or a small penalty like -50 if desired
-        desc = "Moved to Jail."
-        return {"reward": reward_contribution, "card_specific_desc": desc}
+
+    def enable_logging(self, enabled=True, step_log=None):
+        """Turns the detailed per-step log on or off. With a StepLog the entries are written
+        into its columns; otherwise each one is returned as the step() info dict."""
+        self._log_enabled = enabled
+        self.step_log = step_log
+
+    def _refill_rolls(self):
+        # One row per step: [jail die 1, jail die 2, die 1, die 2, card draw], in the layout _step_numeric reads
+        self._roll_buf = np.empty((RNG_BUFFER_SIZE, 5), dtype=np.int64)
+        self._roll_buf[:, :4] = self._rng.integers(1, 7, size=(RNG_BUFFER_SIZE, 4))
+        self._roll_buf[:, 4] = self._rng.integers(0, 1 << 15, size=RNG_BUFFER_SIZE) # Reduced modulo the deck length
+        self._roll_idx = 0
+
+    def _card_desc(self, card_id, card_reward):
+        """Log description of a card effect already applied by the kernel."""
+        if card_id == CARD_ADVANCE_GO:
+            return "Advanced to GO." + (f" Collected ${self.go_reward}." if card_reward > 0 else "")
+        if card_id == CARD_GO_TO_JAIL:
+            return "Moved to Jail."
+        return f"Adjusted money by {CARD_MONEY[card_id]}."
 
     def reset(self):
-        self.positions = [0] * self.num_players
-        self.money = [self.start_money] * self.num_players
-        self.in_jail = [False] * self.num_players
-        self.jail_counters = [0] * self.num_players
-        # Initialize properties with owners set to None
-        # During environment initialization
-        self.properties = []
-        for pos in range(40):  # Assuming a standard Monopoly board with 40 positions
-            if pos in self.property_details:
-                prop = self.property_details[pos].copy()
-                prop["owner"] = None
-                prop["houses"] = 0  # New: Initialize with 0 houses
-            else:
-                prop = {"price": 0, "rent": 0, "owner": None, "houses": 0}
-            self.properties.append(prop)
+        self.positions.fill(0)
+        self.money.fill(self.start_money)
+        self.money_bin.fill(min(max(self.start_money, self.min_money), self.max_money, STATE_MAX_MONEY) // 100)
+        self.in_jail.fill(False)
+        self.jail_counters.fill(0)
+        self.prop_owner.fill(-1)
+        self.prop_houses.fill(0)
+        self.group_owner.fill(-1)
+        for owned in self.owned_by_player:
+            owned.clear()
 
         self.current_player = 0
         self.steps_taken = 0 # Renamed from 'steps' to avoid conflict
@@ -212,30 +457,39 @@ class MonopolyEnv(gym.Env):
 
     # Renamed from _get_state to follow Gym convention
     def _get_obs(self):
-        owners = [prop["owner"] if prop["owner"] is not None else -1 for prop in self.properties]
-        obs = np.array(
-            self.positions +
-            self.money +
-            [int(j) for j in self.in_jail] + # Convert bool to int
-            owners +
-            [self.current_player],
-            dtype=np.int32
-        )
+        n = self.num_players
+        obs = self._obs_buf
+        obs[0:n] = self.positions
+        obs[2 * n:3 * n] = self.in_jail # bool -> int
+        obs[3 * n:3 * n + self.board_size] = self.prop_owner
+        obs[-1] = self.current_player
         # Ensure obs fits within the defined observation space boundaries
-        # This involves clamping money to avoid exceeding the high value
-        obs[self.num_players : 2 * self.num_players] = np.clip(
-            obs[self.num_players : 2 * self.num_players],
-            self.observation_space.low[self.num_players],
-            self.observation_space.high[self.num_players]
-        )
+        # Money is capped *before* it is narrowed to the (possibly int16) buffer, then floored in place (no temporaries)
+        money_obs = obs[n:2 * n]
+        np.minimum(self.money, self.max_money, out=money_obs)
+        np.maximum(money_obs, self.min_money, out=money_obs)
         return obs
 
+    def _update_group_owner(self, pos):
+        """Recomputes group_owner for the color group of pos after prop_owner[pos] changed."""
+        c = self.color_of[pos]
+        if c < 0:
+            return
+        owners = self.prop_owner[self.group_members[c]]
+        self.group_owner[c] = owners[0] if (owners == owners[0]).all() else -1
+
+    def _update_money_bin(self, player):
+        """Recomputes money_bin for player after money[player] changed."""
+        self.money_bin[player] = min(max(int(self.money[player]), self.min_money), self.max_money, STATE_MAX_MONEY) // 100
+
+    def owns_color_group(self, player, pos):
+        """True if player owns every square of pos's color group (O(1), via group_owner)."""
+        c = self.color_of[pos]
+        return c >= 0 and self.group_owner[c] == player
+
     def _player_has_properties(self, player_index):
         """Checks if the specified player owns any properties."""
-        for prop in self.properties:
-            if prop.get("owner") == player_index: # Use .get for safety, although owner should exist
-                return True # Found at least one property
-        return False # Looped through all properties, none owned by player
+        return bool((self.prop_owner == player_index).any())
 
     def step(self, action): # Action is 0 (Pass) or 1 (Buy)
         if self.done:
@@ -244,289 +498,129 @@ class MonopolyEnv(gym.Env):
             return self._get_obs(), 0, self.done, {"action_desc": "Game already ended."}
 
         p = self.current_player
-        reward = 0 # Base reward for the step
+        money_before_turn = int(self.money[p])
+        rolls = self._roll_buf[self._roll_idx]
+        self._roll_idx += 1
+        if self._roll_idx == RNG_BUFFER_SIZE:
+            self._refill_rolls()
+
+        # The whole turn (jail, movement, cards, square action, bankruptcy) runs in the compiled kernel
+        rec = self._log_rec
+        reward, done, next_player = _step_numeric(
+            self.prop_owner, self.prop_price, self.rent_table, self.prop_houses, self.positions, self.money,
+            self.in_jail, self.jail_counters, p, action, rolls, rec, self.square_kind, self.fee_lookup,
+            self.chance_cards, self.chest_cards, self.go_reward, self.jail_position, self.jail_turns
+        )
+        reward = int(reward)
+        self.done = bool(done)
+        self.current_player = int(next_player) # Unchanged when the game ended
+        self.steps_taken += 1
+
+        # Keep the money bins and ownership caches in sync with what the kernel changed
+        self._update_money_bin(p)
+        if rec[LOG_EVENT] == EVENT_RENT: # Rent also paid the owner
+            self._update_money_bin(self.prop_owner[rec[LOG_SQUARE]])
+        if rec[LOG_EVENT] == EVENT_BUY:
+            pos = int(rec[LOG_SQUARE])
+            self._update_group_owner(pos)
+            self.owned_by_player[p].add(pos)
+        if rec[LOG_BANKRUPT]: # All of p's properties went back to the bank
+            self.group_owner[self.group_owner == p] = -1
+            self.owned_by_player[p].clear()
+
+        info = _EMPTY_INFO
+        if self._log_enabled:
+            info = self._log_step(p, action, rolls, money_before_turn, reward)
+        return self._get_obs(), reward, self.done, info
+
+    def _log_step(self, p, action, rolls, money_before_turn, reward):
+        """Builds the log entry (text included) of the step just played from the kernel's record."""
+        rec = self._log_rec.tolist()
+        names = self.prop_names
+
+        if rec[LOG_JAIL] == JAIL_STAYED:
+            pos = int(self.positions[p])
+            return self._create_log_entry(
+                player=p, pos_before=pos, dice=0, # No move dice roll
+                pos_after=pos, money_before=money_before_turn,
+                money_after=int(self.money[p]), reward=reward, fee_paid=0,
+                log_desc=f"Player {p} failed to roll doubles in jail (Turn {self.jail_counters[p]}).",
+                action_taken=action, # Log agent action even if unused
+                landed_on=pos # Didn't land anywhere new
+            )
+
         log_action_desc = ""
-        money_before_turn = self.money[p]
-        fee_paid = 0 # Track fees/rent paid this turn
-        card_name_drawn = "" # Store card name if drawn
-        card_spec_desc_drawn = "" # Store specific card description
-        card_reward_contribution = 0 # Store reward specifically from card
-
-        # --- Jail Logic ---
-        if self.in_jail[p]:
-            self.jail_counters[p] += 1
-            dice1 = random.randint(1, 6)
-            dice2 = random.randint(1, 6)
-            rolled_doubles = (dice1 == dice2)
-            turn_limit_reached = (self.jail_counters[p] >= self.jail_turns)
-
-            if rolled_doubles:
-                self.in_jail[p] = False
-                self.jail_counters[p] = 0
-                log_action_desc = f"Player {p} rolled doubles ({dice1}) to get out of jail. "
-                # Player will now proceed to normal dice roll below
-            elif turn_limit_reached:
-                self.in_jail[p] = False
-                self.jail_counters[p] = 0
-                jail_fee = 50
-                self.money[p] -= jail_fee
-                fee_paid += jail_fee # Log the fee paid
-                card_reward_contribution -= jail_fee # Apply penalty for paying
-                log_action_desc = f"Player {p} paid ${jail_fee} to get out of jail (turn limit). "
-                # Player will now proceed to normal dice roll below
-            else: # Failed to roll doubles, turn ends here
-                log_action_desc = f"Player {p} failed to roll doubles in jail (Turn {self.jail_counters[p]})."
-                self._next_player()
-                # Log turn spent in jail
-                final_reward = reward + card_reward_contribution # Total reward for this step
-                info = self._create_log_entry(
-                    player=p, pos_before=self.positions[p], dice=0, # No move dice roll
-                    pos_after=self.positions[p], money_before=money_before_turn,
-                    money_after=self.money[p], reward=final_reward, fee_paid=fee_paid,
-                    log_desc=log_action_desc, action_taken=action, # Log agent action even if unused
-                    card_drawn=card_name_drawn, card_spec_desc=card_spec_desc_drawn,
-                    landed_on=self.positions[p] # Didn't land anywhere new
-                )
-                # Need to increment step counter here for the skipped turn
-                self.steps_taken += 1
-                return self._get_obs(), final_reward, self.done, info # Return for the jail turn
-
-        # --- Normal Turn: Dice Roll and Movement ---
-        prev_position = self.positions[p]
-        dice1 = random.randint(1, 6)
-        dice2 = random.randint(1, 6)
-        dice_total = dice1 + dice2
-
-        # Calculate initial landing position
-        landed_position_this_turn = (prev_position + dice_total) % self.board_size
-
-        # Check for passing GO based on initial landing
-        # Note: This check should happen BEFORE potential card move effects change position again
-        passed_go = landed_position_this_turn < prev_position
-        if passed_go:
-            self.money[p] += self.go_reward
-            reward += self.go_reward # Add GO reward to base step reward
+        if rec[LOG_JAIL] == JAIL_DOUBLES:
+            log_action_desc = f"Player {p} rolled doubles ({rolls[0]}) to get out of jail. "
+        elif rec[LOG_JAIL] == JAIL_PAID:
+            log_action_desc = f"Player {p} paid ${JAIL_FEE} to get out of jail (turn limit). "
+        if rec[LOG_PASSED_GO]:
             log_action_desc += f"Passed GO, collected ${self.go_reward}. "
 
-        # Tentatively update position
-        self.positions[p] = landed_position_this_turn
-        pos = self.positions[p] # Current position for evaluation
-
         # --- Card Handling ---
-        if pos in self.chance_positions:
-            card = random.choice(self.chance_deck)
-            card_name_drawn = card["name"]
-            log_action_desc += f"Landed on Chance ({pos}), drew '{card_name_drawn}'. "
-            card_effect_info = card["effect"](p) # Effect function modifies state
-            card_reward_contribution += card_effect_info.get("reward", 0)
-            card_spec_desc_drawn = card_effect_info.get("card_specific_desc", "")
-            pos = self.positions[p] # IMPORTANT: Update pos in case card moved the player
-
-        elif pos in self.chest_positions:
-            card = random.choice(self.chest_deck)
-            card_name_drawn = card["name"]
-            log_action_desc += f"Landed on Community Chest ({pos}), drew '{card_name_drawn}'. "
-            card_effect_info = card["effect"](p) # Effect function modifies state
-            card_reward_contribution += card_effect_info.get("reward", 0)
-            card_spec_desc_drawn = card_effect_info.get("card_specific_desc", "")
-            pos = self.positions[p] # IMPORTANT: Update pos in case card moved the player
-
-        # Append the specific card description to the main log description
-        if card_spec_desc_drawn:
-            log_action_desc += card_spec_desc_drawn + " "
-
-        # --- Process Square Actions (based on final position 'pos' after potential card move) ---
-        current_property = self.properties[pos]
-        prop_price = current_property["price"]
-        prop_rent = current_property["rent"]
-        prop_owner = current_property["owner"]
-        prop_houses = current_property.get("houses", 0)
-
-        # 1. Go To Jail Square
-        if pos == self.go_to_jail_position:
-            # No double penalty if card already sent player here
-            if not (card_name_drawn == "Go to Jail"):
-                log_action_desc += f"Landed on Go To Jail ({pos}). Moved to Jail. "
-                effect_info = self.go_to_jail(p) # Call effect to set state
-                card_reward_contribution += effect_info.get("reward", 0) # Add potential penalty/reward
-                # Note: go_to_jail already updates self.positions[p]
-                pos = self.positions[p] # Ensure pos reflects Jail position (10)
-
-        # 2. Fee Squares
-        elif pos in self.fee_positions:
-            fee = self.fee_positions[pos]
-            self.money[p] -= fee
-            fee_paid += fee
-            card_reward_contribution -= fee # Apply fee penalty via card reward accumulator
-            log_action_desc += f"Paid fee of ${fee} on square {pos} ({current_property['name']}). "
-
-        # 3. Property Squares
-        elif prop_price > 0:
-            # a) Unowned
-            if prop_owner is None:
-                can_afford = self.money[p] >= prop_price
-                if can_afford:
-                    if action == 1:
-                        self.money[p] -= prop_price
-                        self.properties[pos]["owner"] = p
-                        self.properties[pos]["houses"] = 0
-                        fee_paid += prop_price
-                        log_action_desc += f"Player {p} chose to BUY property {pos} ({current_property['name']}) for ${prop_price}. "
-                    else:
-                        log_action_desc += f"Player {p} chose NOT to buy property {pos} ({current_property['name']}) (${prop_price}). "
-                else:
-                     log_action_desc += f"Player {p} cannot afford property {pos} ({current_property['name']}) (${prop_price}). "
-            # b) Owned by opponent
-            elif prop_owner != p:
-                num_houses = current_property["houses"]
-                rent_due = prop_rent * (num_houses + 1) # Simplified rent
-                payment = min(rent_due, self.money[p])
-                self.money[p] -= payment
-                self.money[prop_owner] += payment
-                fee_paid += payment
-                card_reward_contribution -= payment # Negative reward for paying rent
-                log_action_desc += f"Paid ${payment} rent to Player {prop_owner} at property {pos} ({current_property['name']}) with {num_houses} houses. "
-            # c) Owned by self
-            else:
-                 log_action_desc += f"Landed on own property {pos} ({current_property['name']}). "
-
-        # 4. Other non-action squares (like Just Visiting, Free Parking)
-        elif pos not in [0, self.jail_position, self.go_to_jail_position] and pos not in self.fee_positions and pos not in self.chance_positions and pos not in self.chest_positions:
-             log_action_desc += f"Landed on non-action square {pos} ({current_property['name']}). "
-
-        # --- Check for Bankruptcy (at the very end of money changes) ---
-        if self.money[p] < 0:
-            self.done = True
-            card_reward_contribution -= 1000 # Bankruptcy penalty
+        landed = rec[LOG_LANDED]
+        card_id = rec[LOG_CARD]
+        card_name_drawn = "" # Store card name if drawn
+        card_spec_desc_drawn = "" # Store specific card description
+        if card_id >= 0:
+            card_name_drawn = CARD_NAMES[card_id]
+            card_spec_desc_drawn = self._card_desc(card_id, rec[LOG_CARD_REWARD])
+            deck_name = "Chance" if self.square_kind[landed] == SQUARE_CHANCE else "Community Chest"
+            log_action_desc += f"Landed on {deck_name} ({landed}), drew '{card_name_drawn}'. {card_spec_desc_drawn} "
+
+        # --- Square Action (on the square after any card move) ---
+        pos, event, amount = rec[LOG_SQUARE], rec[LOG_EVENT], rec[LOG_AMOUNT]
+        if event == EVENT_GO_TO_JAIL:
+            log_action_desc += f"Landed on Go To Jail ({pos}). Moved to Jail. "
+        elif event == EVENT_FEE:
+            log_action_desc += f"Paid fee of ${amount} on square {pos} ({names[pos]}). "
+        elif event == EVENT_BUY:
+            log_action_desc += f"Player {p} chose to BUY property {pos} ({names[pos]}) for ${amount}. "
+        elif event == EVENT_PASS:
+            log_action_desc += f"Player {p} chose NOT to buy property {pos} ({names[pos]}) (${amount}). "
+        elif event == EVENT_CANT_AFFORD:
+            log_action_desc += f"Player {p} cannot afford property {pos} ({names[pos]}) (${amount}). "
+        elif event == EVENT_RENT:
+            log_action_desc += f"Paid ${amount} rent to Player {self.prop_owner[pos]} at property {pos} ({names[pos]}) with {self.prop_houses[pos]} houses. "
+        elif event == EVENT_OWN:
+            log_action_desc += f"Landed on own property {pos} ({names[pos]}). "
+        elif self.quiet_square[pos]: # Other non-action squares (like Just Visiting, Free Parking)
+            log_action_desc += f"Landed on non-action square {pos} ({names[pos]}). "
+
+        if rec[LOG_BANKRUPT]:
             log_action_desc += f"Player {p} went bankrupt! "
-            # Asset liquidation
-            for i, prop in enumerate(self.properties):
-                if prop["owner"] == p:
-                    self.properties[i]["owner"] = None
-                    self.properties[i]["houses"] = 0
-
-               # --- Check for Need to Resolve Debt (AFTER all normal turn actions) ---
-        if self.money[p] < 0 and not self.done:
-            log_action_desc += f"Player {p} is bankrupt (${self.money[p]}). Attempting to sell assets. "
-            bankruptcy_resolved = False
-
-            # --- Phase 1: Sell Houses/Hotels ---
-            # Create a list of properties owned by the player to iterate over
-            owned_property_indices = [i for i, prop in enumerate(self.properties) if prop.get("owner") == p]
-
-            # Sell houses evenly is complex, simplification: sell all houses everywhere first
-            houses_sold_total_value = 0
-            for i in owned_property_indices:
-                prop = self.properties[i]
-                house_cost = prop.get("house_cost", 0) # Get house cost, default 0 if not applicable (railroad/utility)
-                if house_cost > 0 and prop["houses"] > 0:
-                    num_houses_to_sell = prop["houses"]
-                    sell_value_per_house = house_cost // 2 # Sell houses for half cost
-                    money_from_houses = num_houses_to_sell * sell_value_per_house
-
-                    self.money[p] += money_from_houses
-                    prop["houses"] = 0 # Remove all houses/hotel
-                    houses_sold_total_value += money_from_houses
-                    log_action_desc += f"Sold {num_houses_to_sell} houses/hotel on {prop['name']} for ${money_from_houses}. "
-
-                    # Check if solvent after selling houses on this property
-                    if self.money[p] >= 0:
-                        bankruptcy_resolved = True
-                        log_action_desc += f"Player {p} is now solvent (${self.money[p]}) after selling houses. "
-                        break # Stop selling houses
-
-            # If still bankrupt after trying to sell all houses, proceed to sell properties
-            if not bankruptcy_resolved and self.money[p] < 0:
-                log_action_desc += "Still bankrupt after selling houses. Selling properties. "
-
-                # --- Phase 2: Sell Properties (like mortgaging) ---
-                # Simplification: Sell in the order they appear in the list for half price
-                properties_sold_total_value = 0
-                # Iterate over a copy of the indices, as we modify the underlying list properties
-                indices_to_potentially_sell = list(owned_property_indices)
-
-                for i in indices_to_potentially_sell:
-                    # Re-check ownership in case something changed (unlikely here)
-                    if self.properties[i].get("owner") == p:
-                        prop = self.properties[i]
-                        # Can only sell if it has no houses (should be true after Phase 1)
-                        if prop["houses"] == 0:
-                            sell_price = prop["price"] // 2 # Sell for half purchase price (like mortgage)
-                            self.money[p] += sell_price
-                            self.properties[i]["owner"] = None # Forfeit property to bank
-                            properties_sold_total_value += sell_price
-                            log_action_desc += f"Sold property {prop['name']} for ${sell_price}. "
-
-                            # Check if solvent after selling this property
-                            if self.money[p] >= 0:
-                                bankruptcy_resolved = True
-                                log_action_desc += f"Player {p} is now solvent (${self.money[p]}) after selling properties. "
-                                break # Stop selling properties
-                        else:
-                            # Should not happen if Phase 1 worked correctly
-                             log_action_desc += f"Skipped selling {prop['name']} because it still has houses (error?). "
-
-
-            # --- Final Verdict ---
-            if not bankruptcy_resolved and self.money[p] < 0:
-                 # Still bankrupt after selling everything possible
-                 self.done = True # Set game end flag
-                 # card_reward_contribution -= 1000 # Apply bankruptcy penalty AFTER trying to resolve
-                 log_action_desc += f"Player {p} could not raise enough funds. Final balance: ${self.money[p]}. Game Over! "
-                 # Forfeit any remaining properties (shouldn't be any, but just in case)
-                 for i, prop in enumerate(self.properties):
-                      if prop["owner"] == p:
-                          self.properties[i]["owner"] = None
-                          self.properties[i]["houses"] = 0
-            elif bankruptcy_resolved:
-                 # Player managed to survive this time
-                 log_action_desc += f"Player {p} survived bankruptcy. Current balance: ${self.money[p]}. "
-                 # No game-ending penalty applied if they survive
-            else:
-                 # This case means money became >= 0 during the checks, but resolved flag wasn't set? Error.
-                 log_action_desc += f"Bankruptcy resolution logic error. Final balance: ${self.money[p]}. "
-                 if self.money[p] < 0: # Double check if truly bankrupt
-                    self.done = True
-                    log_action_desc += " Still bankrupt despite flag. Game Over! "
-
-
-        # --- Finalize Step (Rest of the code remains the same) ---
-        self.steps_taken += 1
-        # Note: reward calculation happens BEFORE bankruptcy check,
-        # but penalty is added via card_reward_contribution if game truly ends
-        final_reward = reward + card_reward_contribution
 
-        info = self._create_log_entry(
+        return self._create_log_entry(
             player=p,
-            pos_before=prev_position,
-            dice=dice_total,
-            pos_after=self.positions[p],
+            pos_before=rec[LOG_POS_BEFORE],
+            dice=int(rolls[2] + rolls[3]),
+            pos_after=int(self.positions[p]),
             money_before=money_before_turn,
-            money_after=self.money[p], # Log final money after potential selling
-            reward=final_reward,
-            fee_paid=fee_paid,
+            money_after=int(self.money[p]),
+            reward=reward,
+            fee_paid=rec[LOG_FEE_PAID],
             log_desc=log_action_desc.strip(),
             action_taken=action,
             card_drawn=card_name_drawn,
             card_spec_desc=card_spec_desc_drawn,
-            landed_on=landed_position_this_turn
+            landed_on=landed,
+            action_desc_code=event
         )
 
-        # Advance player ONLY if the game is not done
-        if not self.done:
-            self._next_player()
-
-        return self._get_obs(), final_reward, self.done, info
-
-
-    def _next_player(self):
-        self.current_player = (self.current_player + 1) % self.num_players
-        # Skip bankrupt players (basic implementation)
-        # while self.money[self.current_player] < 0:
-        #      self.current_player = (self.current_player + 1) % self.num_players
-
         # Add 'card_spec_desc' parameter with a default value
-    def _create_log_entry(self, player, pos_before, dice, pos_after, money_before, money_after, reward, fee_paid, log_desc, action_taken=None, card_drawn="", card_spec_desc="", landed_on=-1): # <-- ADDED card_spec_desc="" HERE
+    def _create_log_entry(self, player, pos_before, dice, pos_after, money_before, money_after, reward, fee_paid, log_desc, action_taken=None, card_drawn="", card_spec_desc="", landed_on=-1, action_desc_code=EVENT_NONE): # <-- ADDED card_spec_desc="" HERE
+        if self.step_log is not None:
+            # Columnar log: one row written in place, nothing returned as info
+            self.step_log.add(
+                self.steps_taken, player, pos_before, dice, landed_on, pos_after, money_before, money_after,
+                reward, self.done, bool(self.in_jail[player]), fee_paid, action_taken, log_desc.strip(), action_desc_code,
+                str([
+                    {"position": i, "name": self.prop_names[i], "houses": int(self.prop_houses[i])}
+                    for i in sorted(self.owned_by_player[player])
+                ]),
+                card_drawn, card_spec_desc
+            )
+            return _EMPTY_INFO
         entry = {
             "episode_id": -1, # Will be overwritten by generate_episode
             "step": self.steps_taken,
@@ -539,23 +633,34 @@ class MonopolyEnv(gym.Env):
             "money_after": money_after,
             "reward": reward,
             "done": self.done,
-            "in_jail": self.in_jail[player],
+            "in_jail": bool(self.in_jail[player]),
             "fee_paid": fee_paid,
             "action_desc": log_desc.strip(),
+            "action_desc_code": action_desc_code,
             "agent_action": action_taken,
             "owned_properties": [
                 {
                     "position": i,
-                    "name": prop["name"],
-                    "houses": prop["houses"]
+                    "name": self.prop_names[i],
+                    "houses": int(self.prop_houses[i])
                 }
-                for i, prop in enumerate(self.properties)
-                if prop["owner"] == player
+                for i in sorted(self.owned_by_player[player]) # Board order, as before
             ],
             "card": card_drawn,
             "card_specific_desc": card_spec_desc # Now uses the accepted parameter
         }
         return entry
+    def run_episodes(self, n_episodes, q, ret_cnt, epsilon=0.1, max_steps=500, seed=-1):
+        """Plays and learns from n_episodes entirely in compiled code (no logs are produced).
+        q / ret_cnt are the agent's (num_states, 2) tables and are updated in place."""
+        return _run_episodes(
+            n_episodes, q, ret_cnt, epsilon, max_steps, seed,
+            self.num_players, self.start_money, self.max_money,
+            self.prop_price, self.rent_table, self.square_kind, self.fee_lookup,
+            self.chance_cards, self.chest_cards,
+            self.go_reward, self.jail_position, self.jail_turns
+        )
+
     def render(self, mode='human'):
         # Simple text-based rendering
         print("-" * 20)
@@ -563,103 +668,618 @@ class MonopolyEnv(gym.Env):
         for p in range(self.num_players):
             jail_status = "In Jail" if self.in_jail[p] else ""
             print(f"  Player {p}: Pos={self.positions[p]}, Money=${self.money[p]} {jail_status}")
-        owners_str = [str(p['owner']) if p['owner'] is not None else '.' for p in self.properties]
+        owners_str = [str(o) if o >= 0 else '.' for o in self.prop_owner]
         print(f"  Owners: [{' '.join(owners_str[:10])}]")
         print(f"          [{' '.join(owners_str[10:20])}]")
         print(f"          [{' '.join(owners_str[20:30])}]")
         print(f"          [{' '.join(owners_str[30:40])}]")
 
 
+# --- Compiled Game Kernel ---
+# Numeric-only version of MonopolyEnv.step() (no logging) so whole episodes can run in machine code.
+@njit(cache=True, fastmath=True)
+def _step_numeric(prop_owner, prop_price, rent_table, prop_houses, positions, money, in_jail, jail_counters,
+                  current_player, action, rolls, log, square_kind, fee_lookup, chance_cards, chest_cards,
+                  go_reward, jail_position, jail_turns):
+    """Plays one turn for current_player. rolls = [jail die 1, jail die 2, die 1, die 2, card draw].
+    Fills log (LOG_SIZE ints, see LOG_*) with what happened. Returns (reward, done, next_player)."""
+    board_size = prop_owner.shape[0]
+    num_players = positions.shape[0]
+    p = current_player
+    reward = 0
+    done = False
+    fee_paid = 0
+    log[LOG_JAIL] = JAIL_NONE
+    log[LOG_POS_BEFORE] = positions[p]
+    log[LOG_PASSED_GO] = 0
+    log[LOG_LANDED] = positions[p]
+    log[LOG_CARD] = -1
+    log[LOG_CARD_REWARD] = 0
+    log[LOG_SQUARE] = positions[p]
+    log[LOG_EVENT] = EVENT_NONE
+    log[LOG_AMOUNT] = 0
+    log[LOG_FEE_PAID] = 0
+    log[LOG_BANKRUPT] = 0
+
+    # --- Jail Logic ---
+    if in_jail[p]:
+        jail_counters[p] += 1
+        if rolls[0] == rolls[1]: # Rolled doubles
+            in_jail[p] = False
+            jail_counters[p] = 0
+            log[LOG_JAIL] = JAIL_DOUBLES
+        elif jail_counters[p] >= jail_turns: # Pay to get out
+            in_jail[p] = False
+            jail_counters[p] = 0
+            money[p] -= JAIL_FEE
+            reward -= JAIL_FEE
+            fee_paid += JAIL_FEE
+            log[LOG_JAIL] = JAIL_PAID
+        else: # Turn spent in jail
+            log[LOG_JAIL] = JAIL_STAYED
+            return reward, done, (p + 1) % num_players
+
+    # --- Dice Roll and Movement ---
+    raw = positions[p] + rolls[2] + rolls[3]
+    if raw >= board_size: # Passed GO
+        raw -= board_size
+        money[p] += go_reward
+        reward += go_reward
+        log[LOG_PASSED_GO] = 1
+    positions[p] = raw
+    pos = raw
+    log[LOG_LANDED] = pos
+
+    # --- Card Handling ---
+    card = -1
+    kind = square_kind[pos]
+    if kind == SQUARE_CHANCE:
+        card = chance_cards[rolls[4] % chance_cards.shape[0]]
+    elif kind == SQUARE_CHEST:
+        card = chest_cards[rolls[4] % chest_cards.shape[0]]
+    card_reward = 0
+    if card == CARD_ADVANCE_GO:
+        if positions[p] > 0: # Only collect if not already at GO
+            card_reward = go_reward
+        positions[p] = 0
+    elif card == CARD_GO_TO_JAIL:
+        positions[p] = jail_position
+        in_jail[p] = True
+        jail_counters[p] = 0
+    elif card >= 0:
+        card_reward = CARD_MONEY[card]
+    money[p] += card_reward
+    reward += card_reward
+    log[LOG_CARD] = card
+    log[LOG_CARD_REWARD] = card_reward
+    pos = positions[p]
+    log[LOG_SQUARE] = pos
+
+    # --- Square Actions ---
+    kind = square_kind[pos]
+    if kind == SQUARE_GO_TO_JAIL:
+        positions[p] = jail_position
+        in_jail[p] = True
+        jail_counters[p] = 0
+        log[LOG_EVENT] = EVENT_GO_TO_JAIL
+    elif kind == SQUARE_FEE:
+        fee = fee_lookup[pos]
+        money[p] -= fee
+        reward -= fee
+        fee_paid += fee
+        log[LOG_EVENT] = EVENT_FEE
+        log[LOG_AMOUNT] = fee
+    elif kind == SQUARE_PROPERTY:
+        owner = prop_owner[pos]
+        if owner < 0:
+            price = prop_price[pos]
+            log[LOG_AMOUNT] = price
+            if money[p] < price:
+                log[LOG_EVENT] = EVENT_CANT_AFFORD
+            elif action == 1:
+                money[p] -= price
+                prop_owner[pos] = p
+                prop_houses[pos] = 0
+                fee_paid += price
+                log[LOG_EVENT] = EVENT_BUY
+            else:
+                log[LOG_EVENT] = EVENT_PASS
+        elif owner != p:
+            payment = min(rent_table[pos, prop_houses[pos]], money[p])
+            money[p] -= payment
+            money[owner] += payment
+            reward -= payment
+            fee_paid += payment
+            log[LOG_EVENT] = EVENT_RENT
+            log[LOG_AMOUNT] = payment
+        else:
+            log[LOG_EVENT] = EVENT_OWN
+    log[LOG_FEE_PAID] = fee_paid
+
+    # --- Bankruptcy ---
+    if money[p] < 0:
+        done = True
+        reward -= 1000
+        log[LOG_BANKRUPT] = 1
+        for i in range(board_size): # Asset liquidation
+            if prop_owner[i] == p:
+                prop_owner[i] = -1
+                prop_houses[i] = 0
+        return reward, done, p
+
+    return reward, done, (p + 1) % num_players
+
+
+@njit(cache=True)
+def _roll(rolls):
+    """Fills the rolls array used by _step_numeric."""
+    for i in range(4):
+        rolls[i] = np.random.randint(1, 7)
+    rolls[4] = np.random.randint(0, 1 << 15)
+
+
+@njit(cache=True)
+def _pack_state_key(pos, money_bin, in_jail, owner):
+    """Packs one agent state into an int (bit layout in the STATE_*_SHIFT constants)."""
+    return (
+        np.int64(pos)
+        | (np.int64(money_bin) << STATE_MONEY_SHIFT)
+        | (np.int64(1 if in_jail else 0) << STATE_JAIL_SHIFT)
+        | ((np.int64(owner) + 1) << STATE_OWNER_SHIFT)
+    )
+
+
+@njit(cache=True)
+def _mc_update(states, actions, rewards, q, ret_cnt, visited):
+    """First-visit Monte Carlo update for one episode, walking it backwards. q is kept as the running
+    mean of the returns (no per-pair sum needed). visited is an all-False (num_states, 2) scratch array;
+    it is cleared again before returning."""
+    G = 0.0
+    for t in range(states.shape[0] - 1, -1, -1):
+        G += rewards[t]
+        s, a = states[t], actions[t]
+        if not visited[s, a]:
+            visited[s, a] = True
+            ret_cnt[s, a] += 1
+            q[s, a] += (G - q[s, a]) / ret_cnt[s, a]
+    for t in range(states.shape[0]):
+        visited[states[t], actions[t]] = False
+
+
+@njit(cache=True, fastmath=True)
+def _run_episodes(n_episodes, q, ret_cnt, epsilon, max_steps, seed,
+                  num_players, start_money, max_money, prop_price, rent_table, square_kind, fee_lookup,
+                  chance_cards, chest_cards, go_reward, jail_position, jail_turns):
+    """Same loop as the Python driver (generate_episode + update) with an epsilon-greedy policy over q.
+    q and ret_cnt are indexed by the packed state key and updated in place. Returns total steps."""
+    if seed >= 0:
+        np.random.seed(seed)
+    board_size = prop_price.shape[0]
+    visited = np.zeros(q.shape, dtype=np.bool_)
+
+    positions = np.zeros(num_players, dtype=np.int8)
+    money = np.zeros(num_players, dtype=np.int32)
+    in_jail = np.zeros(num_players, dtype=np.bool_)
+    jail_counters = np.zeros(num_players, dtype=np.int8)
+    prop_owner = np.full(board_size, -1, dtype=np.int8)
+    prop_houses = np.zeros(board_size, dtype=np.int8)
+    rolls = np.zeros(5, dtype=np.int64)
+    log = np.zeros(LOG_SIZE, dtype=np.int64) # Filled by every step, not read here
+    # Episode history: packed state key, action and reward per step
+    hist_states = np.zeros(max_steps + 1, dtype=np.int64)
+    hist_actions = np.zeros(max_steps + 1, dtype=np.int64)
+    hist_rewards = np.zeros(max_steps + 1, dtype=np.float64)
+    total_steps = 0
+
+    for episode in range(n_episodes):
+        positions[:] = 0
+        money[:] = start_money
+        in_jail[:] = False
+        jail_counters[:] = 0
+        prop_owner[:] = -1
+        prop_houses[:] = 0
+        p = 0
+        done = False
+        n = 0
+
+        while not done:
+            # State the agent decides in (same packing as MonteCarloAgent._get_state_key)
+            pos = positions[p]
+            owner = prop_owner[pos]
+            state = _pack_state_key(pos, min(max(money[p], 0), max_money, STATE_MAX_MONEY) // 100, in_jail[p], owner)
+
+            # Epsilon-greedy buy decision, only when the square is buyable
+            action = 0
+            if square_kind[pos] == SQUARE_PROPERTY and owner < 0 and money[p] >= prop_price[pos]:
+                if np.random.random() < epsilon:
+                    action = np.random.randint(0, 2)
+                else:
+                    q0 = q[state, 0]
+                    q1 = q[state, 1]
+                    if q0 == q1:
+                        action = np.random.randint(0, 2)
+                    elif q1 > q0:
+                        action = 1
+
+            _roll(rolls)
+            reward, done, p = _step_numeric(
+                prop_owner, prop_price, rent_table, prop_houses, positions, money, in_jail, jail_counters,
+                p, action, rolls, log, square_kind, fee_lookup, chance_cards, chest_cards,
+                go_reward, jail_position, jail_turns
+            )
+            hist_states[n] = state
+            hist_actions[n] = action
+            hist_rewards[n] = reward
+            n += 1
+            if n > max_steps: # Same step limit as generate_episode
+                done = True
+
+        _mc_update(hist_states[:n], hist_actions[:n], hist_rewards[:n], q, ret_cnt, visited)
+        total_steps += n
+
+    return total_steps
+
+
+@njit(cache=True, parallel=True)
+def _step_batch(prop_owner, prop_price, rent_table, prop_houses, positions, money, in_jail, jail_counters,
+                current_player, actions, rolls, logs, rewards, dones, square_kind, fee_lookup,
+                chance_cards, chest_cards, go_reward, jail_position, jail_turns):
+    """Plays one turn in every env (row) in parallel. Writes rewards/dones/logs and advances current_player."""
+    for i in prange(prop_owner.shape[0]):
+        reward, done, next_player = _step_numeric(
+            prop_owner[i], prop_price, rent_table, prop_houses[i], positions[i], money[i], in_jail[i],
+            jail_counters[i], current_player[i], actions[i], rolls[i], logs[i], square_kind, fee_lookup,
+            chance_cards, chest_cards, go_reward, jail_position, jail_turns
+        )
+        rewards[i] = reward
+        dones[i] = done
+        current_player[i] = next_player
+
+
+# --- Vectorized Environment ---
+class MonopolyVectorEnv:
+    """Steps num_envs independent games at once. Every state field has a leading (num_envs,) axis.
+    Finished games (bankruptcy or max_steps) are reset automatically inside step()."""
+    xp = np # Array module holding the state (CuPy for the GPU env)
+
+    def __init__(self, num_envs=4096, max_steps=500, seed=None, **env_kwargs):
+        # Single-game env only used for the static board tables and the observation space
+        self.board = MonopolyEnv(**env_kwargs)
+        self.num_envs = num_envs
+        self.num_players = self.board.num_players
+        self.board_size = self.board.board_size
+        self.max_steps = max_steps
+        self.action_space = self.board.action_space
+        self.observation_space = self.board.observation_space
+        self._rng = np.random.default_rng(seed)
+
+        xp, n, num_players = self.xp, num_envs, self.num_players
+        self.positions = xp.zeros((n, num_players), dtype=np.int8)
+        self.money = xp.zeros((n, num_players), dtype=np.int32)
+        self.in_jail = xp.zeros((n, num_players), dtype=np.bool_)
+        self.jail_counters = xp.zeros((n, num_players), dtype=np.int8)
+        self.prop_owner = xp.zeros((n, self.board_size), dtype=np.int8)
+        self.prop_houses = xp.zeros((n, self.board_size), dtype=np.int8)
+        self.current_player = xp.zeros(n, dtype=np.int64)
+        self.steps_taken = xp.zeros(n, dtype=np.int64)
+        self.rewards = xp.zeros(n, dtype=np.int64)
+        self.dones = xp.zeros(n, dtype=np.bool_)
+        self._buy_price = xp.asarray(self.board.buy_price) # Copied once (to the device for the GPU env)
+        self._alloc_step_buffers()
+        self._obs_buf = xp.empty((n, 3 * num_players + self.board_size + 1), dtype=self.observation_space.dtype)
+        self.reset()
+
+    def _alloc_step_buffers(self):
+        """Host buffers the CPU kernel reads its dice from and writes its per-step records to."""
+        n = self.num_envs
+        self._rolls = np.zeros((n, 5), dtype=np.int64)
+        self.step_logs = np.zeros((n, LOG_SIZE), dtype=np.int64) # Kernel record of each env's last step (LOG_*)
+
+    def reset(self):
+        self._reset_envs(slice(None))
+        return self._get_obs()
+
+    def _reset_envs(self, idx):
+        self.positions[idx] = 0
+        self.money[idx] = self.board.start_money
+        self.in_jail[idx] = False
+        self.jail_counters[idx] = 0
+        self.prop_owner[idx] = -1
+        self.prop_houses[idx] = 0
+        self.current_player[idx] = 0
+        self.steps_taken[idx] = 0
+
+    def _get_obs(self):
+        n = self.num_players
+        obs = self._obs_buf
+        obs[:, 0:n] = self.positions
+        obs[:, 2 * n:3 * n] = self.in_jail
+        obs[:, 3 * n:3 * n + self.board_size] = self.prop_owner
+        obs[:, -1] = self.current_player
+        money_obs = obs[:, n:2 * n]
+        self.xp.minimum(self.money, self.board.max_money, out=money_obs)
+        self.xp.maximum(money_obs, self.board.min_money, out=money_obs)
+        return obs
+
+    def state_keys(self):
+        """Packed agent state of the current player in every env (same layout as MonteCarloAgent._get_state_key)."""
+        xp, env_idx = self.xp, self.xp.arange(self.num_envs)
+        p = self.current_player
+        pos = self.positions[env_idx, p].astype(np.int64)
+        money_bin = xp.clip(self.money[env_idx, p], 0, min(self.board.max_money, STATE_MAX_MONEY)) // 100
+        owner = self.prop_owner[env_idx, pos].astype(np.int64)
+        return (
+            pos
+            | (money_bin.astype(np.int64) << STATE_MONEY_SHIFT)
+            | (self.in_jail[env_idx, p].astype(np.int64) << STATE_JAIL_SHIFT)
+            | ((owner + 1) << STATE_OWNER_SHIFT)
+        )
+
+    def buyable_mask(self):
+        """True for the envs where the current player stands on an unowned property they can afford."""
+        env_idx = self.xp.arange(self.num_envs)
+        p = self.current_player
+        pos = self.positions[env_idx, p]
+        price = self._buy_price[pos]
+        return (price > 0) & (self.prop_owner[env_idx, pos] < 0) & (self.money[env_idx, p] >= price)
+
+    def step(self, actions):
+        """actions: array of 0 (Pass) / 1 (Buy), one per env. Returns (obs, rewards, dones, info)."""
+        board = self.board
+        # Dice for all envs in one call, plus the card draw column
+        self._rolls[:, :4] = self._rng.integers(1, 7, size=(self.num_envs, 4))
+        self._rolls[:, 4] = self._rng.integers(0, 1 << 15, size=self.num_envs)
+        global _parallel_layer_started
+        _parallel_layer_started = True # From here on numba's thread pool may be running (see train_parallel)
+        _step_batch(
+            self.prop_owner, board.prop_price, board.rent_table, self.prop_houses, self.positions, self.money,
+            self.in_jail, self.jail_counters, self.current_player, np.asarray(actions), self._rolls, self.step_logs,
+            self.rewards, self.dones, board.square_kind, board.fee_lookup,
+            board.chance_cards, board.chest_cards,
+            board.go_reward, board.jail_position, board.jail_turns
+        )
+        self.steps_taken += 1
+        self.dones |= self.steps_taken > self.max_steps # Same step limit as generate_episode
+
+        info = {}
+        finished = np.flatnonzero(self.dones)
+        if finished.size:
+            info["final_money"] = self.money[finished].copy()
+            info["finished_envs"] = finished
+            self._reset_envs(finished)
+        return self._get_obs(), self.rewards.copy(), self.dones.copy(), info
+
+
+# --- GPU Vectorized Environment ---
+if HAS_CUDA:
+    # Same turn logic as the CPU kernel, compiled as a CUDA device function
+    _step_device = cuda.jit(device=True)(_step_numeric.py_func)
+
+    @cuda.jit
+    def monopoly_step_kernel(prop_owner, prop_price, rent_table, prop_houses, positions, money, in_jail,
+                             jail_counters, current_player, actions, rewards, dones, rng, square_kind,
+                             fee_lookup, chance_cards, chest_cards,
+                             go_reward, jail_position, jail_turns):
+        """One thread per env: draws its own dice, then plays one turn."""
+        i = cuda.grid(1)
+        if i >= prop_owner.shape[0]:
+            return
+        rolls = cuda.local.array(5, dtype=np.int64)
+        for k in range(4):
+            rolls[k] = min(int(xoroshiro128p_uniform_float32(rng, i) * 6), 5) + 1
+        rolls[4] = int(xoroshiro128p_uniform_float32(rng, i) * (1 << 15))
+        log = cuda.local.array(LOG_SIZE, dtype=np.int64) # Per-step record, not kept on the GPU
+        reward, done, next_player = _step_device(
+            prop_owner[i], prop_price, rent_table, prop_houses[i], positions[i], money[i], in_jail[i],
+            jail_counters[i], current_player[i], actions[i], rolls, log, square_kind, fee_lookup,
+            chance_cards, chest_cards, go_reward, jail_position, jail_turns
+        )
+        rewards[i] = reward
+        dones[i] = done
+        current_player[i] = next_player
+
+
+    class MonopolyVectorEnvGPU(MonopolyVectorEnv):
+        """MonopolyVectorEnv with all state in CuPy arrays, stepped by one CUDA thread per env.
+        Observations, rewards and dones stay on the device."""
+        xp = cp
+        threads_per_block = 128
+
+        def __init__(self, num_envs=4096, max_steps=500, seed=None, **env_kwargs):
+            super().__init__(num_envs=num_envs, max_steps=max_steps, seed=seed, **env_kwargs)
+            board = self.board
+            # Static board tables copied to the device once
+            self._tables = tuple(cp.asarray(t) for t in (
+                board.prop_price, board.rent_table, board.square_kind, board.fee_lookup,
+                board.chance_cards, board.chest_cards
+            ))
+            self._rng_states = create_xoroshiro128p_states(num_envs, seed=0 if seed is None else seed)
+
+        def _alloc_step_buffers(self):
+            pass # Each CUDA thread draws its own dice and keeps its step record in local memory
+
+        def step(self, actions):
+            board = self.board
+            prop_price, rent_table, square_kind, fee_lookup, chance_cards, chest_cards = self._tables
+            blocks = (self.num_envs + self.threads_per_block - 1) // self.threads_per_block
+            monopoly_step_kernel[blocks, self.threads_per_block](
+                self.prop_owner, prop_price, rent_table, self.prop_houses, self.positions, self.money,
+                self.in_jail, self.jail_counters, self.current_player, cp.asarray(actions), self.rewards,
+                self.dones, self._rng_states, square_kind, fee_lookup, chance_cards, chest_cards,
+                board.go_reward, board.jail_position, board.jail_turns
+            )
+            self.steps_taken += 1
+            self.dones |= self.steps_taken > self.max_steps # Same step limit as generate_episode
+
+            info = {}
+            finished = cp.flatnonzero(self.dones)
+            if finished.size:
+                info["final_money"] = self.money[finished].copy()
+                info["finished_envs"] = finished
+                self._reset_envs(finished)
+            return self._get_obs(), self.rewards.copy(), self.dones.copy(), info
+
+
+def make_vector_env(num_envs=4096, **kwargs):
+    """Returns the GPU vectorized env when CUDA is available, otherwise the CPU one."""
+    if HAS_CUDA:
+        return MonopolyVectorEnvGPU(num_envs=num_envs, **kwargs)
+    return MonopolyVectorEnv(num_envs=num_envs, **kwargs)
+
+
+# --- Parallel Rollouts ---
+# Set once MonopolyVectorEnv.step has run the parallel kernel; forking after that is unsafe
+_parallel_layer_started = False
+# Worker-side state, set once per process by _rollout_init
+_worker_env = None
+_worker_tables = None
+
+def _rollout_close():
+    """Worker exit finalizer: releases the worker's handles on the shared tables."""
+    global _worker_tables
+    for shm, _ in _worker_tables:
+        shm.close()
+    _worker_tables = None
+
+def _rollout_init(shm_names, env_kwargs):
+    """Pool initializer: attaches to the driver's shared q / ret_cnt and builds a board."""
+    global _worker_env, _worker_tables
+    _worker_env = MonopolyEnv(**env_kwargs)
+    _worker_tables = []
+    for name, dtype in zip(shm_names, (np.float64, np.int32)):
+        shm = shared_memory.SharedMemory(name=name)
+        _worker_tables.append((shm, np.ndarray((1 << STATE_KEY_BITS, 2), dtype=dtype, buffer=shm.buf)))
+    # Runs when the worker exits normally (the pool is closed and joined, not terminated)
+    mp_util.Finalize(None, _rollout_close, exitpriority=10)
+
+def _rollout_worker(task):
+    """Runs n_episodes from a private copy of the shared tables.
+    Returns only what changed: (flat indices, added return sums, added visit counts)."""
+    n_episodes, epsilon, max_steps, seed = task
+    q, ret_cnt = (table.copy() for _, table in _worker_tables)
+    _worker_env.run_episodes(n_episodes, q, ret_cnt, epsilon, max_steps, seed)
+    shared_q, shared_cnt = (table.ravel() for _, table in _worker_tables)
+    idx = np.flatnonzero(ret_cnt.ravel() != shared_cnt)
+    q, ret_cnt = q.ravel()[idx], ret_cnt.ravel()[idx]
+    # Sum of this worker's new returns: mean * count after, minus mean * count before
+    delta_sum = q * ret_cnt - shared_q[idx] * shared_cnt[idx]
+    return idx, delta_sum, ret_cnt - shared_cnt[idx]
+
+
 # --- Agent Class ---
 class MonteCarloAgent:
-    def __init__(self, action_space, num_players, epsilon=0.1): # Added num_players parameter
+    # The two actions of the binary buy decision
+    _PASS = 0
+    _BUY = 1
+
+    def __init__(self, action_space, num_players, epsilon=0.1, seed=None, board_size=40): # Added num_players parameter
         self.epsilon = epsilon
+        # Uniform draws for exploration / tie breaking come from a pre-generated buffer
+        self.rng = np.random.default_rng(seed)
+        self._refill_uniforms()
         self.action_space = action_space
         self.num_players = num_players  # <--- MAKE SURE THIS LINE IS PRESENT
-        self.returns = defaultdict(lambda: defaultdict(list))
-        self.q_values = defaultdict(lambda: defaultdict(float))
+        check_state_key_fits(num_players, board_size) # Owner and position fields of the packed state key
+        # Dense tables indexed by [packed state key, action]; Q is the running mean of the observed returns
+        num_states = 1 << STATE_KEY_BITS
+        self.q = np.zeros((num_states, 2), dtype=np.float64)
+        self.ret_cnt = np.zeros((num_states, 2), dtype=np.int32)
+        self._visited = np.zeros((num_states, 2), dtype=np.bool_) # Scratch for the first-visit check
+        # Episode history buffers, reused by every generate_episode call (an episode is at most max_steps + 1 steps)
+        self.max_steps = 500
+        self._hist_states = np.zeros(self.max_steps + 1, dtype=np.int64)
+        self._hist_actions = np.zeros(self.max_steps + 1, dtype=np.int64)
+        self._hist_rewards = np.zeros(self.max_steps + 1, dtype=np.float64)
         # Policy is implicitly epsilon-greedy based on Q-values
 
-    def _get_state_tuple(self, obs):
-        # Use the stored self.num_players
-        num_players = self.num_players # <-- FIX: Use stored value
-
-        # The rest of the method uses num_players correctly now
-        positions = tuple(obs[0 : num_players])
-        money = tuple(obs[num_players : 2 * num_players])
-        money_bins = tuple(m // 100 for m in money)
-        in_jail = tuple(obs[2 * num_players : 3 * num_players])
-        owners_start_idx = 3 * num_players
-        current_player_idx = obs[-1]
-        current_pos = obs[current_player_idx]
-        current_prop_owner = obs[owners_start_idx + current_pos]
-        state_tuple = (
-            positions[current_player_idx],
-            money_bins[current_player_idx],
-            current_prop_owner,
-            in_jail[current_player_idx]
+    def _refill_uniforms(self):
+        # Kept as a Python list: indexing it is cheaper than indexing a numpy array per draw
+        self._u = self.rng.random(RNG_BUFFER_SIZE).tolist()
+        self._ui = 0
+
+    def _get_state_key(self, obs, env):
+        """Packs the current player's (position, money bin, in_jail, owner of current square) into one int."""
+        num_players = self.num_players
+        item = obs.item # Reads Python ints straight from the buffer (no numpy scalar per field)
+        p = item(-1)
+        pos = item(p)
+        money_bin = env.money_bin.item(p) # Maintained by env.step, no bucketing here
+        in_jail = item(2 * num_players + p)
+        current_prop_owner = item(3 * num_players + pos)
+        return (
+            pos
+            | (money_bin << STATE_MONEY_SHIFT)
+            | (in_jail << STATE_JAIL_SHIFT)
+            | ((current_prop_owner + 1) << STATE_OWNER_SHIFT)
         )
-        return state_tuple
 
-    def select_action(self, state_tuple, current_obs, env):
+    def select_action(self, state_key, current_obs, env):
         """Selects action (0 or 1) based on epsilon-greedy policy."""
 
         # --- Determine if a 'Buy' decision is even possible ---
         p = env.current_player # Get current player from env
         pos = env.positions[p]
-        prop = env.properties[pos]
-        is_buyable = prop["price"] > 0 and prop["owner"] is None and env.money[p] >= prop["price"]
+        price = env.buy_price[pos] # One table read: 0 on squares that cannot be bought
+        is_buyable = price > 0 and env.prop_owner[pos] < 0 and env.money[p] >= price
 
         # If not on a buyable square, the only logical action is 0 (Pass/Continue)
         if not is_buyable:
-            return 0
+            return self._PASS
 
         # --- If buyable, use Epsilon-Greedy ---
-        possible_actions = [0, 1] # 0: Don't Buy, 1: Buy
-
-        if random.random() < self.epsilon:
-            return random.choice(possible_actions)  # Explore
+        # Two uniforms per decision: one for explore vs exploit, one to pick among the candidate actions
+        i = self._ui
+        if i + 2 > RNG_BUFFER_SIZE:
+            self._refill_uniforms()
+            i = 0
+        u_explore, u_pick = self._u[i], self._u[i + 1]
+        self._ui = i + 2
+
+        if u_explore < self.epsilon:
+            return self._BUY if u_pick >= 0.5 else self._PASS  # Explore
         else:
             # Exploit: Choose action with highest Q-value for this state
-            q_vals = [self.q_values[state_tuple][a] for a in possible_actions]
-            max_q = max(q_vals)
-
-            # Handle cases where Q-values might be zero or equal
-            if max_q == 0.0 and all(q == 0.0 for q in q_vals):
-                 best_actions = possible_actions # If all Q=0, explore among options
-            else:
-                 best_actions = [a for a, q in zip(possible_actions, q_vals) if q == max_q]
+            q0, q1 = self.q[state_key].tolist() # One row read gives both actions' Q-values
 
-            return random.choice(best_actions) # Break ties randomly
+            # Equal Q-values (including an unvisited state, both 0): break the tie randomly
+            if q0 == q1:
+                return self._BUY if u_pick >= 0.5 else self._PASS
+            return self._BUY if q1 > q0 else self._PASS
 
-    def generate_episode(self, env, episode_id=None):
-        """Generates one episode playing the game."""
+    def generate_episode(self, env, episode_id=-1):
+        """Generates one episode playing the game. The returned history is (state_keys, actions, rewards),
+        views into the agent's buffers that stay valid until the next call."""
         obs = env.reset()
+        if env.step_log is not None:
+            env.step_log.episode_id = episode_id
         done = False
-        episode_history = [] # Stores (state_tuple, action, reward) for MC update
+        hist_states, hist_actions, hist_rewards = self._hist_states, self._hist_actions, self._hist_rewards
         detailed_logs = []   # Stores the detailed log dict from env.step
         step_count = 0
 
         while not done:
             current_player = env.current_player # Who's turn is it?
-            state_tuple = self._get_state_tuple(obs) # Get the simplified, hashable state for the agent
+            state_key = self._get_state_key(obs, env) # Get the simplified, packed state for the agent
 
             # Agent selects action based on its policy and the *potential* decision
-            action = self.select_action(state_tuple, obs, env)
+            action = self.select_action(state_key, obs, env)
 
             # Environment processes the turn based on dice rolls and the agent's action
             next_obs, reward, done, info = env.step(action)
 
             # Store data for MC update *using the state the decision was made in*
-            episode_history.append((state_tuple, action, reward))
+            hist_states[step_count] = state_key
+            hist_actions[step_count] = action
+            hist_rewards[step_count] = reward
 
-            # Store detailed log, adding episode_id
-            info["episode_id"] = episode_id
-            detailed_logs.append(info)
+            # Store detailed log, adding episode_id (info is empty when env logging is off)
+            if info:
+                info["episode_id"] = episode_id
+                detailed_logs.append(info)
 
             obs = next_obs
             step_count += 1
-            if step_count > 500: # Add a max step limit to prevent infinite loops
+            if step_count > self.max_steps: # Add a max step limit to prevent infinite loops
                 # print(f"Episode {episode_id} reached step limit.")
                 done = True # Force end episode
 
@@ -668,34 +1288,120 @@ class MonteCarloAgent:
             #     env.render()
 
 
+        episode_history = (hist_states[:step_count], hist_actions[:step_count], hist_rewards[:step_count])
         return episode_history, detailed_logs
 
     def update(self, episode_history):
-        """Updates Q-values using First-Visit Monte Carlo."""
-        G = 0  # Cumulative reward (Return)
-        visited_state_actions = set() # Keep track for first-visit MC
-
-        # Iterate backwards through the episode
-        for state_tuple, action, reward in reversed(episode_history):
-            G += reward # Update return G
-
-            state_action_pair = (state_tuple, action)
-
-            # First-visit Monte Carlo check: only update the first time this (s,a) was visited
-            if state_action_pair not in visited_state_actions:
-                # Append return G to the list for this state-action pair
-                self.returns[state_tuple][action].append(G)
-                # Update Q-value as the average of observed returns
-                self.q_values[state_tuple][action] = sum(self.returns[state_tuple][action]) / len(self.returns[state_tuple][action])
-
-                visited_state_actions.add(state_action_pair)
-                # Policy improvement is implicit via epsilon-greedy action selection in the next episode
+        """Updates Q-values using First-Visit Monte Carlo. episode_history is (state_keys, actions, rewards)."""
+        states, actions, rewards = episode_history
+        _mc_update(states, actions, rewards, self.q, self.ret_cnt, self._visited)
+        # Policy improvement is implicit via epsilon-greedy action selection in the next episode
+
+    def select_action_batch(self, state_keys, buyable, rng):
+        """Epsilon-greedy actions for many envs at once; only buyable lanes can choose to buy."""
+        actions = np.zeros(state_keys.shape[0], dtype=np.int64)
+        lanes = np.flatnonzero(buyable)
+        if lanes.size:
+            q = self.q[state_keys[lanes]]
+            coin = rng.integers(0, 2, size=lanes.size) # Exploration and tie breaking
+            greedy = np.where(q[:, 0] == q[:, 1], coin, q[:, 1] > q[:, 0])
+            explore = rng.random(lanes.size) < self.epsilon
+            actions[lanes] = np.where(explore, coin, greedy)
+        return actions
+
+    def train_batched(self, vec_env, num_episodes, seed=None):
+        """Plays episodes in lockstep on a (CPU) MonopolyVectorEnv and runs the MC update on each
+        finished game. Stops after num_episodes finished games. Returns total steps."""
+        rng = np.random.default_rng(seed)
+        n = vec_env.num_envs
+        env_idx = np.arange(n)
+        # Per-env episode history; an episode is at most max_steps + 1 steps long
+        hist_states = np.zeros((n, vec_env.max_steps + 1), dtype=np.int64)
+        hist_actions = np.zeros((n, vec_env.max_steps + 1), dtype=np.int64)
+        hist_rewards = np.zeros((n, vec_env.max_steps + 1), dtype=np.float64)
+        lengths = np.zeros(n, dtype=np.int64)
+        finished_episodes = total_steps = 0
+
+        vec_env.reset()
+        while finished_episodes < num_episodes:
+            state_keys = vec_env.state_keys()
+            actions = self.select_action_batch(state_keys, vec_env.buyable_mask(), rng)
+            _, rewards, _, info = vec_env.step(actions)
+            hist_states[env_idx, lengths] = state_keys
+            hist_actions[env_idx, lengths] = actions
+            hist_rewards[env_idx, lengths] = rewards
+            lengths += 1
+            total_steps += n
+
+            if "finished_envs" in info:
+                finished = info["finished_envs"]
+                for i in finished[:num_episodes - finished_episodes]:
+                    length = lengths[i]
+                    _mc_update(hist_states[i, :length], hist_actions[i, :length], hist_rewards[i, :length],
+                               self.q, self.ret_cnt, self._visited)
+                finished_episodes += min(finished.size, num_episodes - finished_episodes)
+                lengths[finished] = 0 # These envs were reset by step()
+        return total_steps
+
+    def train_compiled(self, env, num_episodes, max_steps=500, seed=-1):
+        """Runs num_episodes of generate_episode + update in compiled code, without logs. Returns total steps."""
+        return env.run_episodes(num_episodes, self.q, self.ret_cnt, self.epsilon, max_steps, seed)
+
+    def train_parallel(self, num_episodes, num_workers=None, sync_every=500, max_steps=500, seed=0, **env_kwargs):
+        """Splits num_episodes over worker processes running the compiled episode loop.
+        Every sync_every episodes the workers' new returns are merged into Q and it is rebroadcast.
+        Workers are forked (this script has no __main__ guard to re-import under spawn), so this needs a
+        platform with fork (not Windows) and must run before any MonopolyVectorEnv.step in the process."""
+        if "fork" not in mp.get_all_start_methods():
+            raise RuntimeError("train_parallel needs the 'fork' start method, which this platform does not have; "
+                               "use train_compiled instead")
+        if _parallel_layer_started:
+            raise RuntimeError("train_parallel cannot fork after MonopolyVectorEnv.step started numba's thread pool; "
+                               "run it first or in a fresh process")
+        num_workers = num_workers or os.cpu_count()
+        tables = (self.q, self.ret_cnt)
+        shms = [shared_memory.SharedMemory(create=True, size=t.nbytes) for t in tables]
+        shared = [np.ndarray(t.shape, dtype=t.dtype, buffer=shm.buf) for t, shm in zip(tables, shms)]
+        # fork: workers inherit the compiled functions instead of re-running this script
+        ctx = mp.get_context("fork")
+        try:
+            with ctx.Pool(num_workers, initializer=_rollout_init,
+                          initargs=([shm.name for shm in shms], env_kwargs)) as pool:
+                done = 0
+                while done < num_episodes:
+                    for dst, src in zip(shared, tables):
+                        dst[:] = src
+                    chunk = min(sync_every, num_episodes - done)
+                    tasks = [
+                        (chunk // num_workers + (w < chunk % num_workers), self.epsilon, max_steps,
+                         seed + done + w)
+                        for w in range(num_workers)
+                    ]
+                    # Return sums are only needed while merging: sum = mean * count
+                    q, ret_cnt = self.q.ravel(), self.ret_cnt.ravel()
+                    ret_sum = q * ret_cnt
+                    for idx, delta_sum, delta_cnt in pool.map(_rollout_worker, tasks):
+                        ret_sum[idx] += delta_sum
+                        ret_cnt[idx] += delta_cnt
+                    visited = ret_cnt > 0
+                    q[visited] = ret_sum[visited] / ret_cnt[visited]
+                    done += chunk
+                # Let the workers exit normally so their finalizers close the shared memory handles
+                pool.close()
+                pool.join()
+        finally:
+            del shared
+            for shm in shms:
+                shm.close()
+                shm.unlink()
 
 
 # Simulation Parameters
 num_episodes = 10000 # Number of episodes to run
 epsilon_value = 0.2 # Exploration rate (start higher, maybe decay later)
-log_filename = "monopoly_rl_log_properties_with_house.csv" # Name for the CSV log file
+# Log file format: Parquet when pyarrow is installed, CSV otherwise (set to "csv" to always get a text log)
+log_format = "parquet" if HAS_PYARROW else "csv"
+log_filename = "monopoly_rl_log_properties_with_house." + log_format
 
 # Remove old log file if it exists
 if os.path.exists(log_filename):
@@ -709,34 +1415,34 @@ if os.path.exists(log_filename):
 # Initialize Environment and Agent
 env = MonopolyEnv(num_players=2)
 # Pass num_players to the agent's constructor
-agent = MonteCarloAgent(action_space=env.action_space, num_players=env.num_players, epsilon=epsilon_value) # Ensure num_players is passed here
+agent = MonteCarloAgent(action_space=env.action_space, num_players=env.num_players, epsilon=epsilon_value,
+                        board_size=env.board_size) # Ensure num_players is passed here
 
 # Define log headers
 log_headers = [
     "episode_id", "step", "player", "position_before", "dice_roll", "landed_on_position","position_after",
     "money_before", "money_after", "reward", "done", "in_jail", "fee_paid",
-    "agent_action", "action_desc", "owned_properties", "card","card_specific_desc"
+    "agent_action", "action_desc", "action_desc_code", "owned_properties", "card","card_specific_desc"
 ]
+# The env writes every step straight into the log's columns; full chunks go to log_filename
+step_log = StepLog(log_filename, log_headers, fmt=log_format)
+env.enable_logging(True, step_log=step_log)
 
 #print(f"Starting Monte Carlo simulation for {num_episodes} episodes...")
 
 # Run Simulation and Log Data
-all_episode_logs = []
 try:
     for episode_id in range(num_episodes):
         # Print progress periodically
         if (episode_id + 1) % 1000 == 0:
             print(f"Running episode {episode_id + 1}/{num_episodes}...")
 
-        # Generate an episode using the agent's policy and get logs
-        episode_history, detailed_logs = agent.generate_episode(env, episode_id=episode_id)
+        # Generate an episode using the agent's policy (its log rows go to step_log)
+        episode_history, _ = agent.generate_episode(env, episode_id=episode_id)
 
         # Update the agent's Q-values based on the episode
         agent.update(episode_history)
 
-        # Accumulate logs
-        all_episode_logs.extend(detailed_logs)
-
         # Optional: Decay epsilon over time
         # if epsilon_value > 0.05:
         #    epsilon_value *= 0.999 # Slow decay
@@ -745,40 +1451,80 @@ try:
 
     print("Simulation finished.")
 
-    # Write logs to CSV after the simulation completes
-    print(f"Writing log data to {log_filename}...")
-    if all_episode_logs: # Check if there's anything to write
-         with open(log_filename, mode="w", newline="", encoding="utf-8") as file:
-            writer = csv.DictWriter(file, fieldnames=log_headers)
-            writer.writeheader()
-            writer.writerows(all_episode_logs)
-         print("Log data saved.")
-    else:
-         print("No log data generated.")
-
-
-
 except Exception as e:
     print(f"\nAn error occurred during simulation or logging: {e}")
     import traceback
     traceback.print_exc() # Print detailed traceback
 
+finally:
+    # Write the last partial chunk of logs (also after an error, so the file is complete and readable)
+    print(f"Writing log data to {log_filename}...")
+    step_log.close()
+    if step_log.rows_written: # Check if there was anything to write
+        print("Log data saved.")
+    else:
+        print("No log data generated.")
+
 # --- Analysis and Plotting ---
 print("Analyzing results...")
 
+def finish_figure(name):
+    """Shows the current figure, or saves it as fig_<name>.png and closes it when HEADLESS."""
+    if HEADLESS:
+        plt.savefig(f'fig_{name}.png', dpi=100)
+        plt.close()
+    else:
+        plt.show()
+
+# Only the columns the plots use, with the dtypes StepLog wrote them in (no type inference)
+analysis_columns = ['episode_id', 'player', 'money_after', 'landed_on_position', 'agent_action', 'action_desc_code']
+analysis_chunk_rows = 200_000
+
+def iter_log_chunks():
+    """Yields the log as DataFrames of at most analysis_chunk_rows rows, in the order they were written."""
+    if log_format == "parquet":
+        for batch in pq.ParquetFile(log_filename).iter_batches(batch_size=analysis_chunk_rows, columns=analysis_columns):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(log_filename, usecols=analysis_columns, engine='c', chunksize=analysis_chunk_rows,
+                               dtype={name: StepLog.dtypes[name] for name in analysis_columns})
+
 if os.path.exists(log_filename):
     try:
-        df = pd.read_csv(log_filename)
-
-        if df.empty:
+        # Calculate rolling window size
+        rolling_window = max(1, num_episodes // 50) # Use a smaller % for potentially shorter episodes
+        num_groups = (num_episodes - 1) // rolling_window + 1
+
+        # One streaming pass over the log fills every accumulator the plots need (never the whole log in memory)
+        total_rows = 0
+        landing_counts = np.zeros(env.board_size, dtype=np.int64)
+        # Each player's last logged money in each episode; later rows (and chunks) overwrite earlier ones
+        final_money_arr = np.full((num_episodes, env.num_players), np.nan)
+        # Buy decisions and buys per group of rolling_window episodes
+        decision_counts = np.zeros(num_groups, dtype=np.int64)
+        buy_counts = np.zeros(num_groups, dtype=np.int64)
+
+        for chunk in iter_log_chunks():
+            total_rows += len(chunk)
+            # Positions are small ints, so one bincount gives the count for every square of the board
+            landing_counts += np.bincount(chunk['landed_on_position'].to_numpy(dtype=np.int64), minlength=env.board_size)
+
+            last = chunk.groupby(['episode_id', 'player'])['money_after'].last() # Rows are written in step order
+            final_money_arr[last.index.get_level_values(0), last.index.get_level_values(1)] = last.to_numpy()
+
+            # Steps where a buy decision was possible and made
+            decisions = chunk[chunk['agent_action'].notna() & chunk['action_desc_code'].isin([EVENT_BUY, EVENT_PASS])]
+            groups = decisions['episode_id'].to_numpy(dtype=np.int64) // rolling_window
+            decision_counts += np.bincount(groups, minlength=num_groups)
+            buy_counts += np.bincount(groups, weights=decisions['agent_action'].to_numpy(dtype=np.int64),
+                                      minlength=num_groups).astype(np.int64)
+
+        if total_rows == 0:
              print("Log file is empty. No analysis performed.")
         else:
-            # Calculate rolling window size
-            # rolling_window = max(1, num_episodes // 50) # Use a smaller % for potentially shorter episodes
-
             # --- Calculate Winner/End Game Stats ---
-            # Find the last step for each episode
-            final_steps_df = df.loc[df.groupby('episode_id')['step'].idxmax()]
+            # One column per player
+            final_money = pd.DataFrame(final_money_arr).ffill() # Fill gaps
 
             # Determine winner (player with most money at the end, or the non-bankrupt one)
             def get_winner(row):
@@ -799,15 +1545,9 @@ if os.path.exists(log_filename):
 
             # 1. Average Final Money per Player Over Time (Rolling Average)
             plt.figure(figsize=(12, 6))
-            for p in range(env.num_players):
-                 player_final_money = final_steps_df[final_steps_df['player'] == p]['money_after']
-                 # Need to align indices if episodes end on different player turns
-                 player_final_money = player_final_money.reindex(range(num_episodes)).ffill() # Fill gaps
-                 if len(player_final_money) >= rolling_window:
-                     rolling_avg = player_final_money.rolling(window=rolling_window).mean()
-                     plt.plot(rolling_avg.index, rolling_avg, label=f'Player {p} Avg Final Money ({rolling_window} ep roll)', alpha=0.8)
-                 else:
-                     plt.plot(player_final_money.index, player_final_money, label=f'Player {p} Final Money', alpha=0.3)
+            rolling_avg = final_money.rolling(window=rolling_window).mean()
+            rolling_avg.columns = [f'Player {p} Avg Final Money ({rolling_window} ep roll)' for p in rolling_avg.columns]
+            rolling_avg.plot(ax=plt.gca(), alpha=0.8)
 
             plt.title("Average Final Money per Player Over Time")
             plt.xlabel("Episode")
@@ -815,28 +1555,26 @@ if os.path.exists(log_filename):
             plt.legend()
             plt.grid(True)
             plt.tight_layout()
-            plt.show()
+            finish_figure('final_money')
 
             # 3. Frequency of Landing on Each Board Position
             plt.figure(figsize=(15, 5))
-            # Ensure plot uses integer bins covering the whole board
-            bins = np.arange(env.board_size + 1) - 0.5
-            plt.hist(df['landed_on_position'], bins=bins, edgecolor='black', density=True, alpha=0.7) # Use density=True for probability
+            landing_probs = landing_counts / landing_counts.sum() # Probability, like density=True
+            plt.bar(np.arange(env.board_size), landing_probs, width=1.0, edgecolor='black', alpha=0.7)
             plt.title("Frequency Distribution of Landing on Board Positions")
             plt.xlabel("Board Position")
             plt.ylabel("Probability")
             plt.xticks(range(env.board_size))
             plt.grid(axis='y', linestyle='--', alpha=0.7)
             plt.tight_layout()
-            plt.show()
+            finish_figure('landing_frequency')
 
             # 4. Agent Actions: Buy vs. Don't Buy Decisions Over Time
-            # Filter logs for steps where a buy decision was possible and made
-            buy_decision_df = df[df['agent_action'].notna() & (df['action_desc'].str.contains("chose to BUY") | df['action_desc'].str.contains("chose NOT to buy"))].copy()
-
-            if not buy_decision_df.empty:
-                buy_decision_df['episode_group'] = (buy_decision_df['episode_id'] // rolling_window) * rolling_window
-                buy_rate_over_time = buy_decision_df.groupby('episode_group')['agent_action'].mean() # Avg action (1=Buy, 0=Pass) gives buy rate
+            if decision_counts.any():
+                # Avg action (1=Buy, 0=Pass) gives buy rate, indexed by the start episode of each group
+                has_decisions = decision_counts > 0
+                buy_rate_over_time = pd.Series(buy_counts[has_decisions] / decision_counts[has_decisions],
+                                               index=np.flatnonzero(has_decisions) * rolling_window)
 
                 plt.figure(figsize=(12, 6))
                 plt.plot(buy_rate_over_time.index, buy_rate_over_time, marker='o', linestyle='-', label=f'Buy Rate (Avg Action) per {rolling_window} Episodes')
@@ -847,7 +1585,7 @@ if os.path.exists(log_filename):
                 plt.legend()
                 plt.grid(True)
                 plt.tight_layout()
-                plt.show()
+                finish_figure('buy_rate')
             else:
                 print("No buy decisions were logged for action analysis.")
 